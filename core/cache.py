@@ -0,0 +1,83 @@
+"""In-memory cache of recent search results
+
+Attributes:
+    DEFAULT_CACHE_SIZE (int): No. of queries whose results are kept by default
+"""
+
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 4096
+
+
+class QueryCache:
+
+    """Least recently used cache of search results keyed by query vector
+
+    All the methods are meant to be called from the event loop thread, so no
+    locking is done.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        """Initialize
+
+        Args:
+            max_size (int, optional): Maximum no. of entries; 0 disables the
+                cache
+        """
+        self._max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(qvec: np.ndarray, *params: Hashable) -> tuple:
+        """Make the cache key of a query
+
+        The key holds the query's exact float32 values, so only identical
+        queries share an entry. Vectors with non-finite values should not be
+        cached (e.g. NaNs with different bit patterns get different keys).
+
+        Args:
+            qvec (np.ndarray): Query vector
+            *params: Other search parameters the results depend on (e.g. `n`)
+
+        Returns:
+            tuple: Key
+        """
+        return (np.ascontiguousarray(qvec, dtype=np.float32).tobytes(),) + params
+
+    def get(self, key: tuple) -> Optional[object]:
+        """Get the cached results for a key (marking it as recently used)
+
+        Args:
+            key (tuple): Key made with `QueryCache.key`
+
+        Returns:
+            object: Cached results, None if there aren't any
+        """
+        results = self._entries.get(key)
+        if results is not None:
+            self._entries.move_to_end(key)
+        return results
+
+    def put(self, key: tuple, results: object):
+        """Store results, evicting the least recently used entry if full
+
+        Args:
+            key (tuple): Key made with `QueryCache.key`
+            results (object): Search results
+        """
+        if self._max_size <= 0:
+            return
+        self._entries[key] = results
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries, e.g. after the indexes have changed"""
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
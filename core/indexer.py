@@ -1,25 +1,55 @@
 """
 Classes used for creating indexes
+
+Attributes:
+    DEFAULT_FACTORY_STRING (str): FAISS indexing configuration used by default,
+        `{nlist}` is replaced with a no. of inverted lists suited to the
+        number of vectors
+    MIN_TRAIN_PER_LIST (int): Minimum no. of training vectors per inverted list
+        of an IVF index
+    SMALL_INDEX_SIZE (int): Indexes of fewer vectors are too small to train
+        the default configuration's codebooks, they are flat (exact) instead
 """
 
 import json
+from typing import Optional
 import numpy as np
 import faiss
+from core.indexes import is_fastscan
+
+DEFAULT_FACTORY_STRING = "OPQ16_64,IVF{nlist},PQ16x4fsr"
+MIN_TRAIN_PER_LIST = 30
+SMALL_INDEX_SIZE = 1000
 
 
 class FaissIndexCreator:
 
     """Puts a list of vectors in an FAISS index and saves it to disk"""
 
-    def __init__(self, factory_string: str, normalize: bool = True):
+    def __init__(
+        self,
+        factory_string: str = DEFAULT_FACTORY_STRING,
+        normalize: bool = True,
+        nprobe: Optional[int] = None,
+    ):
         """Initialise
 
         Args:
-            factory_string (str): Indexing configuration (see FAISS docs)
+            factory_string (str, optional): Indexing configuration (see FAISS
+                docs), defaults to an OPQ rotated IVF index with 4-bit
+                PQ-FastScan codes. A `{nlist}` placeholder is replaced with
+                `4 * sqrt(N)` for an index of `N` vectors, or fewer if there
+                aren't `MIN_TRAIN_PER_LIST` training vectors for each list.
+                The default is replaced with a flat index for fewer than
+                `SMALL_INDEX_SIZE` vectors
             normalize (bool, optional): Convert to unit vectors before indexing
+            nprobe (int, optional): No. of inverted lists to visit when
+                searching an IVF index, saved with the index (the reader's
+                default is used if not given)
         """
         self._factory_string = factory_string
         self._normalize = normalize
+        self._nprobe = nprobe
 
     def create(
         self, name: str, vectors: np.ndarray, labels: list, n_train: int, save_dir: str
@@ -41,7 +71,14 @@ class FaissIndexCreator:
         assert len(vectors) == len(labels)
 
         n_vectors, n_dims = vectors.shape
-        index = faiss.index_factory(n_dims, self._factory_string)
+        n_train_vectors = len(vectors[:n_train])
+        nlist = self._nlist(n_vectors, n_train_vectors)
+        factory_string = self._factory_string.format(nlist=nlist)
+        is_default = self._factory_string == DEFAULT_FACTORY_STRING
+        if is_default and n_vectors < SMALL_INDEX_SIZE:
+            factory_string = "Flat"
+        index = faiss.index_factory(n_dims, factory_string)
+        self._check_training_size(index, n_train_vectors)
 
         if self._normalize:
             faiss.normalize_L2(vectors)
@@ -50,20 +87,48 @@ class FaissIndexCreator:
         index.add(vectors)
         config = {
             "name": name,
-            "factory_string": self._factory_string,
-            "normalized": self.normalize,
+            "factory_string": factory_string,
+            "normalized": self._normalize,
+            "fastscan": is_fastscan(index),
             "dims": n_dims,
             "item_count": n_vectors,
-            "labels": labels,
         }
-        self._save(index, config, save_dir)
-
-    def _save(self, index, config: dict, save_dir: str):
-        """Save index to disk"""
+        if self._nprobe is not None:
+            config["nprobe"] = self._nprobe
+        self._save(index, config, labels, save_dir)
+
+    @staticmethod
+    def _nlist(n_vectors: int, n_train: int):
+        """No. of inverted lists for an IVF index of `n_vectors` vectors,
+        limited to what `n_train` training vectors can train"""
+        nlist = int(4 * np.sqrt(n_vectors))
+        return max(1, min(nlist, n_train // MIN_TRAIN_PER_LIST))
+
+    @staticmethod
+    def _check_training_size(index, n_train: int):
+        """Make sure there are enough training vectors for the index's
+        inverted lists (if any)"""
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return
+        n_required = MIN_TRAIN_PER_LIST * ivf.nlist
+        assert (
+            n_train >= n_required
+        ), f"{ivf.nlist} inverted lists need at least {n_required} training vectors"
+
+    def _save(self, index, config: dict, labels: list, save_dir: str):
+        """Save index to disk
+
+        Labels are saved as a fixed-width byte string array (`.labels.npy`)
+        so that they can be memory-mapped when the index is read
+        """
         name = config["name"]
         faiss.write_index(index, f"{save_dir}/{name}.faiss")
         with open(f"{save_dir}/{name}.metadata.json", "w") as fp:
             json.dump(config, fp)
+        encoded = np.array([label.encode() for label in labels])
+        np.save(f"{save_dir}/{name}.labels.npy", encoded)
 
 
 class AnnoyIndexCreator:
@@ -4,110 +4,638 @@ Attributes:
     CHECK_MARK (str): Unicode symbol for check mark
     USE_ANNOY_INDEXES (1/0): Whether Annoy indexes should be read or ignored
     USE_FAISS_INDEXES (1/0): Whether FAISS indexes should be read or ignored
+    DEFAULT_NPROBE (int): No. of inverted lists visited when searching IVF
+        indexes (FAISS)
+    MMAP_FLAGS (int): FAISS flags for reading an index as a read-only
+        memory-mapped file
+    FASTSCAN_TYPES (tuple): FAISS index classes with PQ-FastScan (4-bit, SIMD
+        table lookup) codes, empty if the installed FAISS lacks them
 """
 
-import json
+import os
+import threading
 from abc import abstractmethod
+from bisect import bisect_right
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from itertools import accumulate
+from typing import List, Optional, Sequence, Tuple
 import numpy as np
+import orjson
 import faiss
 import annoy
 
+DEFAULT_NPROBE = 32
+MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+FASTSCAN_TYPES = tuple(
+    getattr(faiss, name)
+    for name in ("IndexFastScan", "IndexIVFFastScan")
+    if hasattr(faiss, name)
+)
+
+
+def is_fastscan(index) -> bool:
+    """Check if a FAISS index (possibly behind a vector transform, e.g. OPQ)
+    stores PQ-FastScan codes"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return bool(FASTSCAN_TYPES) and isinstance(index, FASTSCAN_TYPES)
+
+
+class LabelArray:
+
+    """Read-only sequence of labels backed by an array of fixed-width byte
+    strings (e.g., a memory-mapped `.labels.npy` file), decoded on access"""
+
+    def __init__(self, array: np.ndarray):
+        """Initialize
+
+        Args:
+            array (np.ndarray): 1D array of UTF-8 encoded labels
+        """
+        self._array = array
+
+    def __getitem__(self, i):
+        """Return the label at position `i`"""
+        return self._array[i].decode()
+
+    def take(self, ids: np.ndarray) -> List[str]:
+        """Return the labels at positions `ids`, gathered in one go"""
+        return [label.decode() for label in self._array[ids].tolist()]
+
+    def __len__(self):
+        """Return the number of labels"""
+        return len(self._array)
+
+
+def take_labels(labels, ids: np.ndarray) -> List[str]:
+    """Look up the labels of several items at once
+
+    Args:
+        labels (sequence): Labels of an index, e.g., a list or `LabelArray`
+        ids (np.ndarray): Item ids (positions in `labels`)
+
+    Returns:
+        list: Labels in the same order as `ids`
+    """
+    if hasattr(labels, "take"):
+        return labels.take(ids)
+    return [labels[i] for i in ids.tolist()]
+
+
+def read_labels(labels_file: str):
+    """Memory-map labels saved as a NumPy array of byte strings
+
+    Args:
+        labels_file (path): A `.labels.npy` file
+
+    Returns:
+        LabelArray: Labels
+    """
+    return LabelArray(np.load(labels_file, mmap_mode="r"))
+
+
+def find_labels(metadata: dict, index_file: str, labels_file: str = None):
+    """Get an index's labels from its `.labels.npy` file, if given or found
+    next to the index file, or else from its metadata (older indexes)
+
+    Args:
+        metadata (dict): Index's metadata
+        index_file (path): Index file
+        labels_file (path, optional): `.labels.npy` file
+
+    Returns:
+        LabelArray or list: Labels
+
+    Raises:
+        ValueError: If there is neither a labels file nor labels in the
+            metadata
+    """
+    if labels_file is None:
+        candidate = f"{os.path.splitext(index_file)[0]}.labels.npy"
+        if os.path.isfile(candidate):
+            labels_file = candidate
+    if labels_file is not None:
+        return read_labels(labels_file)
+    if "labels" not in metadata:
+        raise ValueError(f"{index_file} has no labels file or labels in metadata")
+    return metadata["labels"]
+
+
+class ShardedLabels:
+
+    """Labels of several indexes addressed by global ids, i.e., an item's id
+    within its own index plus the no. of items in the preceding indexes"""
+
+    def __init__(self, label_lists: list):
+        """Initialize
+
+        Args:
+            label_lists (list): Labels of each index, in order
+        """
+        self._lists = label_lists
+        self._ends = list(accumulate(len(labels) for labels in label_lists))
+        self._starts = np.array([0] + self._ends[:-1], dtype="int64")
+
+    def __getitem__(self, i):
+        """Return the label with global id `i`"""
+        shard = bisect_right(self._ends, i)
+        start = self._ends[shard - 1] if shard > 0 else 0
+        return self._lists[shard][i - start]
+
+    def take(self, ids: np.ndarray) -> List[str]:
+        """Return the labels with global ids `ids`
+
+        The shards of all the ids are found with one `np.searchsorted` and the
+        labels of each shard are then gathered together.
+        """
+        shards = np.searchsorted(self._ends, ids, side="right")
+        local_ids = ids - self._starts[shards]
+        labels = [None] * len(ids)
+        for shard in np.unique(shards).tolist():
+            positions = np.flatnonzero(shards == shard)
+            found = take_labels(self._lists[shard], local_ids[positions])
+            for pos, label in zip(positions.tolist(), found):
+                labels[pos] = label
+        return labels
+
+    def __len__(self):
+        """Return the total number of labels"""
+        return self._ends[-1] if self._ends else 0
+
 
 class VectorIndex:
 
     """Abstract class for indexes that stores vectors"""
 
     @abstractmethod
-    def search(self, qvec: np.ndarray, n: int):
+    def search(self, qvec: np.ndarray, n: int) -> List[Tuple[str, float]]:
         """Return mostly similar `n` vectors to query vector `qvec`"""
         raise NotImplementedError
 
+    @abstractmethod
+    def search_batch(self, qvecs: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return ids and distances of `n` most similar vectors to each of the
+        query vectors as `(ids, dists)` arrays; missing results have id -1"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def resolve(self, ids: Sequence[int]) -> List[str]:
+        """Return labels for the given item ids"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def dims(self) -> int:
+        """Return the dimensionality of vectors present in the index"""
+        raise NotImplementedError
+
 
 class FaissIndex(VectorIndex):
 
     """A wrapper around an FAISS index"""
 
-    def __init__(self, index, resolver_fn, name=None):
+    def __init__(self, index, labels, name=None, normalize_queries=True):
         """Initialize
 
         Args:
             index (FAISS index object): Index
-            resolver_fn (method): Method that returns label for an item id
+            labels (list): Labels of the indexed items, in the order of ids
             name (str, optional): Index's identifier
+            normalize_queries (bool, optional): Convert query vectors to unit
+                vectors before searching (should match how the index's vectors
+                were stored)
         """
         self._id = name
         self._index = index
-        self._index2label = resolver_fn
+        self._search = index.search  # bound once, used on every query
+        self._labels = labels
+        self._normalize_queries = normalize_queries
         self._dims = None
-
-    def search(self, qvec, n):
+        self._local = threading.local()
+        self._gpu_search = None
+        self._gpu_min_batch = None
+        self._gpu_lock = threading.Lock()
+        self._hnsw = self._extract_hnsw(index)
+        self._ivf = self._extract_ivf(index)
+        self._nprobe = None
+        self._nprobe_changed = threading.Condition()
+        self._nprobe_users = 0
+        if self._ivf is not None:
+            self._nprobe = DEFAULT_NPROBE
+            self._ivf.nprobe = DEFAULT_NPROBE
+            # Parallelize over the probed inverted lists rather than over
+            # queries, so that a single query is spread over all threads
+            self._ivf.parallel_mode = 1
+
+    @staticmethod
+    def _extract_ivf(index):
+        """Return the inverted file index within `index` (None if there isn't one)"""
+        try:
+            return faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return None
+
+    @staticmethod
+    def _extract_hnsw(index):
+        """Return the HNSW graph of `index` (None if it isn't an HNSW index)"""
+        index = faiss.downcast_index(index)
+        if isinstance(index, faiss.IndexPreTransform):
+            index = faiss.downcast_index(index.index)
+        return index.hnsw if isinstance(index, faiss.IndexHNSW) else None
+
+    def search(
+        self,
+        qvec: Sequence[float],
+        n: int,
+        nprobe: Optional[int] = None,
+        pre_normalized: bool = False,
+    ) -> List[Tuple[str, float]]:
         """Return `n` most similar items to the given query vector
 
         Args:
             qvec (list): Query vector
             n (int): No. of items to return
+            nprobe (int, optional): No. of inverted lists to visit (IVF
+                indexes only), overrides the index's `nprobe` for this search
+            pre_normalized (bool, optional): The query is already a unit
+                vector, so it needn't be normalized again
 
         Returns:
             list: An array of (label, distance) pairs
         """
-        Q = np.array([qvec]).astype("float32")
-        faiss.normalize_L2(Q)
-        ds, ns = self._index.search(Q, n)
-        items = [self._index2label(i) for i in ns[0]]
-        dists = [float(d) for d in ds[0]]
-        return list(zip(items, dists))
+        ns, ds = self.search_batch([qvec], n, nprobe, pre_normalized)
+        items = self.resolve(ns[0])
+        return list(zip(items, ds[0].tolist()))
+
+    def search_batch(
+        self,
+        qvecs: Sequence[Sequence[float]],
+        n: int,
+        nprobe: Optional[int] = None,
+        pre_normalized: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return `n` most similar items for each of the given query vectors
+
+        All queries are (if needed) normalized and searched with a single call
+        to the underlying FAISS index. The query vectors are never modified.
+
+        Args:
+            qvecs (list or np.ndarray): Query vectors, one per row
+            n (int): No. of items to return per query
+            nprobe (int, optional): No. of inverted lists to visit (IVF
+                indexes only), overrides the index's `nprobe` for this search
+            pre_normalized (bool, optional): The queries are already unit
+                vectors (e.g., normalized once for several indexes)
+
+        Returns:
+            tuple: `(ids, dists)` arrays of shape `(len(qvecs), n)`; use
+                `resolve` to get the labels of the ids
+        """
+        if self._normalize_queries and not pre_normalized:
+            Q = self._query_buffer(np.shape(qvecs))
+            np.copyto(Q, qvecs, casting="same_kind")
+            faiss.normalize_L2(Q)
+        else:
+            # Contiguous float32 queries (e.g. shared by several indexes) are
+            # used as they are, without a copy
+            Q = np.ascontiguousarray(qvecs, dtype=np.float32)
+        if nprobe is None and self._uses_gpu(len(Q)):
+            with self._gpu_lock:  # GPU resources are not meant to be shared
+                ds, ns = self._gpu_search(Q, n)
+            return ns, ds
+        with self._probing(nprobe):
+            ds, ns = self._search(Q, n)
+        return ns, ds
+
+    @contextmanager
+    def _probing(self, nprobe: Optional[int] = None):
+        """Visit `nprobe` inverted lists (the index's own `nprobe` if None) in
+        the searches made within this context (IVF indexes only)
+
+        Not all FAISS indexes accept per-search parameters (e.g. FastScan
+        indexes in faiss 1.7.4 don't), so `nprobe` is set on the index itself.
+        Concurrent searches with the same `nprobe` share the setting, others
+        wait until no search uses a different one.
+        """
+        if self._ivf is None:
+            yield
+            return
+        # More lists than exist is moot
+        nprobe = self._nprobe if nprobe is None else min(nprobe, self.nlist)
+        with self._nprobe_changed:
+            self._nprobe_changed.wait_for(
+                lambda: self._nprobe_users == 0 or self._ivf.nprobe == nprobe
+            )
+            self._ivf.nprobe = nprobe
+            self._nprobe_users += 1
+        try:
+            yield
+        finally:
+            with self._nprobe_changed:
+                self._nprobe_users -= 1
+                if self._nprobe_users == 0:
+                    self._nprobe_changed.notify_all()
+
+    def enable_gpu(self, min_batch_size: int) -> bool:
+        """Copy the index to the GPU(s) and search batches of at least
+        `min_batch_size` queries there (smaller batches, for which the
+        transfer to the GPU would cost more than it saves, and searches with
+        a custom `nprobe` stay on the CPU)
+
+        Args:
+            min_batch_size (int): Smallest batch searched on the GPU
+
+        Returns:
+            bool: True if the index can now be searched on the GPU, False if
+                there is no GPU or the index type isn't supported on GPUs
+        """
+        if self._gpu_search is not None:
+            return True
+        if not hasattr(faiss, "index_cpu_to_all_gpus") or faiss.get_num_gpus() < 1:
+            return False
+        try:
+            gpu_index = faiss.index_cpu_to_all_gpus(self._index)
+        except RuntimeError:
+            return False
+        self._gpu_min_batch = min_batch_size
+        self._gpu_search = gpu_index.search
+        return True
+
+    def _uses_gpu(self, batch_size: int) -> bool:
+        """Whether a batch of `batch_size` queries is searched on the GPU"""
+        return self._gpu_search is not None and batch_size >= self._gpu_min_batch
+
+    def _query_buffer(self, shape):
+        """Return the calling thread's scratch array for query vectors
+
+        Queries are copied into this array to be normalized in place, so
+        repeated searches don't allocate a new array each time
+        """
+        buffer = getattr(self._local, "query_buffer", None)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.float32)
+            self._local.query_buffer = buffer
+        return buffer
+
+    def resolve(self, ids: Sequence[int]) -> List[str]:
+        """Return labels for the given item ids
+
+        Args:
+            ids (iterable): Item ids, e.g., a row returned by `search_batch`
+
+        Returns:
+            list: Labels in the same order
+        """
+        return take_labels(self._labels, np.asarray(ids, dtype="int64"))
+
+    @property
+    def nprobe(self):
+        """Get the no. of inverted lists visited per search (None for non-IVF
+        indexes)"""
+        return self._nprobe
+
+    @nprobe.setter
+    def nprobe(self, value):
+        """Set the no. of inverted lists visited per search, higher value =
+        better recall (slower) search"""
+        if self._ivf is None:
+            raise ValueError(f"Index {self._id} is not an IVF index")
+        self._nprobe = value
+
+    @property
+    def nlist(self):
+        """Get the no. of inverted lists (None for non-IVF indexes)"""
+        return None if self._ivf is None else self._ivf.nlist
+
+    @property
+    def ef_search(self):
+        """Get the size of the candidate list kept while searching (None for
+        non-HNSW indexes)"""
+        return None if self._hnsw is None else self._hnsw.efSearch
+
+    @ef_search.setter
+    def ef_search(self, value):
+        """Set the size of the candidate list kept while searching, higher
+        value = better recall (slower) search"""
+        if self._hnsw is None:
+            raise ValueError(f"Index {self._id} is not an HNSW index")
+        self._hnsw.efSearch = value
 
     @property
     def name(self):
         """Get the index's name"""
         return self._id
 
+    def dims(self):
+        """Return the dimensionality of vectors present in the index
+
+        Returns:
+            int: Dimension count
+        """
+        return self._index.d
+
+    @property
+    def faiss_index(self):
+        """Get the underlying FAISS index"""
+        return self._index
+
+    @property
+    def labels(self):
+        """Get the labels of the indexed items, in the order of ids"""
+        return self._labels
+
+    @property
+    def normalize_queries(self):
+        """Whether query vectors are normalized before searching"""
+        return self._normalize_queries
+
+
+class FaissIndexShards(FaissIndex):
+
+    """Several FAISS indexes searched as one with `faiss.IndexShards`
+
+    The shards' results are merged in C++, so a query crosses into FAISS (and
+    is normalized) once instead of once per index. The shards are searched
+    one after the other in the calling thread, each with that thread's
+    OpenMP threads, rather than on threads of their own (which would each
+    start as many OpenMP threads as there are cores).
+    """
+
+    def __init__(self, indexes: list, name=None):
+        """Initialize
+
+        Args:
+            indexes (list): `FaissIndex` objects with the same dimensionality,
+                metric and query normalization
+            name (str, optional): Identifier for the combined index
+
+        Raises:
+            ValueError: If the indexes cannot be searched together
+        """
+        first = indexes[0].faiss_index
+        for idx in indexes:
+            if (
+                idx.faiss_index.d != first.d
+                or idx.faiss_index.metric_type != first.metric_type
+                or idx.normalize_queries != indexes[0].normalize_queries
+            ):
+                raise ValueError(f"Index {idx.name} cannot be sharded with others")
+        shards = faiss.IndexShards(first.d, False, True)  # not threaded, successive ids
+        for idx in indexes:
+            shards.add_shard(idx.faiss_index)
+        labels = ShardedLabels([idx.labels for idx in indexes])
+        self._indexes = indexes
+        super().__init__(
+            shards, labels, name, normalize_queries=indexes[0].normalize_queries
+        )
+
+    @contextmanager
+    def _probing(self, nprobe: Optional[int] = None):
+        """Visit `nprobe` inverted lists (each shard's own `nprobe` if None)
+        of every IVF shard in the searches made within this context
+
+        `faiss.IndexShards` doesn't accept per-search parameters, so `nprobe`
+        is set on each shard (see `FaissIndex._probing`). The shards are
+        always taken in the same order, so that searches of overlapping sets
+        of shards can't wait for each other.
+        """
+        with ExitStack() as stack:
+            for idx in sorted(self._indexes, key=id):
+                stack.enter_context(idx._probing(nprobe))
+            yield
+
+    @property
+    def nprobe(self):
+        """Get the no. of inverted lists visited per search (None unless all
+        shards are IVF indexes)"""
+        nprobes = [idx.nprobe for idx in self._indexes]
+        return None if None in nprobes else max(nprobes)
+
+    @nprobe.setter
+    def nprobe(self, value):
+        """Set the no. of inverted lists visited per search in all shards"""
+        for idx in self._indexes:
+            idx.nprobe = value
+
+    @property
+    def nlist(self):
+        """Get the largest no. of inverted lists of the shards (None unless
+        all shards are IVF indexes)"""
+        nlists = [idx.nlist for idx in self._indexes]
+        return None if None in nlists else max(nlists)
+
+    @property
+    def ef_search(self):
+        """Get the HNSW candidate list size (None unless all shards are HNSW
+        indexes)"""
+        sizes = [idx.ef_search for idx in self._indexes]
+        return None if None in sizes else max(sizes)
+
+    @ef_search.setter
+    def ef_search(self, value):
+        """Set the HNSW candidate list size of all shards"""
+        for idx in self._indexes:
+            idx.ef_search = value
+
+
+def combine_faiss_indexes(indexes: List[VectorIndex]) -> List[VectorIndex]:
+    """Group FAISS indexes that can be searched together (same dimensionality,
+    metric and query normalization) into sharded indexes
+
+    IVF indexes are never grouped with other kinds of indexes, so that a
+    per-search `nprobe` applies to every shard of a group or to none.
+
+    Args:
+        indexes (list): Index objects
+
+    Returns:
+        list: One `FaissIndexShards` per group of FAISS indexes (or the index
+            itself for a group of one), followed by the other indexes
+    """
+    groups = defaultdict(list)
+    others = []
+    for idx in indexes:
+        if isinstance(idx, FaissIndex):
+            index = idx.faiss_index
+            is_ivf = idx.nprobe is not None
+            key = (index.d, index.metric_type, idx.normalize_queries, is_ivf)
+            groups[key].append(idx)
+        else:
+            others.append(idx)
+    combined = [g[0] if len(g) == 1 else FaissIndexShards(g) for g in groups.values()]
+    return combined + others
+
 
 class FaissIndexReader:
 
     """Reads Faiss index and associated labels from disk"""
 
-    def read_from_files(self, index_file, json_file, name=None):
+    def read_from_files(self, index_file, json_file, name=None, labels_file=None):
         """Read index from a `.faiss` and a `.json` file
 
         Args:
             index_file (path): Vector index file
-            json_file (path): JSON file containing vector labels
+            json_file (path): JSON file containing the index's metadata (and,
+                for older indexes, the vector labels)
             name (str, optional): Identifier of index
+            labels_file (path, optional): `.labels.npy` file to read labels
+                from, by default the one next to the index file (if any)
 
         Returns:
             FaissIndex: Index object
+
+        Raises:
+            ValueError: If the index uses FastScan codes that the installed
+                FAISS version cannot read, or if its labels cannot be found
         """
-        index = faiss.read_index(index_file)
         metadata = self._read_json(json_file)
-        labels = metadata["labels"]
-        item_resolver = labels.__getitem__
-        return FaissIndex(index, item_resolver, name)
+        if metadata.get("fastscan") and not FASTSCAN_TYPES:
+            raise ValueError(
+                f"{index_file} is a PQ-FastScan index, which needs faiss>=1.7.3"
+            )
+        index = self._read_index(index_file)
+        labels = find_labels(metadata, index_file, labels_file)
+        normalized = metadata.get("normalized", True)
+        faiss_index = FaissIndex(index, labels, name, normalize_queries=normalized)
+        if metadata.get("nprobe") is not None:
+            faiss_index.nprobe = metadata["nprobe"]
+        return faiss_index
+
+    def _read_index(self, index_file):
+        """Memory-map the index file so that it is paged in on demand (and
+        shared between processes) instead of being copied into RAM, falling
+        back to a regular read for index types which cannot be mapped"""
+        try:
+            return faiss.read_index(index_file, MMAP_FLAGS)
+        except RuntimeError:
+            return faiss.read_index(index_file)
 
     def _read_json(self, json_file):
         """Read metadata from json file"""
-        with open(json_file) as fp:
-            return json.load(fp)
+        with open(json_file, "rb") as fp:
+            return orjson.loads(fp.read())
 
 
 class AnnoyIndex(VectorIndex):
 
     """A wrapper around an AnnoyIndex object"""
 
-    def __init__(self, index: annoy.AnnoyIndex, resolver_fn, name=None):
+    def __init__(self, index: annoy.AnnoyIndex, labels: list, name=None):
         """Initialize
 
         Args:
             index (annoy.AnnoyIndex): Vector index
-            resolver_fn (method): Method that returns label for an item id
+            labels (list): Labels of the indexed items, in the order of ids
             name (str, optional): Identifier for the index
         """
         self._index = index
-        self._index2item = resolver_fn
+        self._get_nns = index.get_nns_by_vector  # bound once, used on every query
+        self._labels = labels
         self._name = name
         self._search_depth = 1000
 
-    def search(self, qvec, n):
+    def search(self, qvec: Sequence[float], n: int) -> List[Tuple[str, float]]:
         """Return `n` most similar items to the given query vector
 
         Args:
@@ -118,10 +646,49 @@ class AnnoyIndex(VectorIndex):
             list: An array of (label, distance) pairs
         """
         d = self._search_depth
-        ids, dists = self._index.get_nns_by_vector(qvec, n, d, True)
-        items = [self._index2item(i) for i in ids]
+        if isinstance(qvec, np.ndarray):
+            qvec = qvec.tolist()  # Annoy reads Python floats much faster
+        ids, dists = self._get_nns(qvec, n, d, True)
+        labels = self._labels
+        items = [labels[i] for i in ids]
         return list(zip(items, dists))
 
+    def search_batch(
+        self, qvecs: Sequence[Sequence[float]], n: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return `n` most similar items for each of the given query vectors
+
+        Args:
+            qvecs (list or np.ndarray): Query vectors, one per row
+            n (int): No. of items to return per query
+
+        Returns:
+            tuple: `(ids, dists)` arrays of shape `(len(qvecs), n)`, padded
+                with id -1 (and infinite distance) if fewer items are found
+        """
+        d = self._search_depth
+        get_nns = self._get_nns
+        ids = np.full((len(qvecs), n), -1, dtype=np.int64)
+        dists = np.full((len(qvecs), n), np.inf, dtype=np.float32)
+        if isinstance(qvecs, np.ndarray):
+            qvecs = qvecs.tolist()  # Annoy reads Python floats much faster
+        for row, qvec in enumerate(qvecs):
+            found, ds = get_nns(qvec, n, d, True)
+            ids[row, : len(found)] = found
+            dists[row, : len(found)] = ds
+        return ids, dists
+
+    def resolve(self, ids: Sequence[int]) -> List[str]:
+        """Return labels for the given item ids
+
+        Args:
+            ids (iterable): Item ids, e.g., a row returned by `search_batch`
+
+        Returns:
+            list: Labels in the same order
+        """
+        return take_labels(self._labels, np.asarray(ids, dtype="int64"))
+
     def set_search_depth(self, d):
         """Set search depth, higher value = more thorough (slower) search
 
@@ -144,8 +711,7 @@ class AnnoyIndex(VectorIndex):
         Returns:
             int: Dimension count
         """
-        v0 = self._index.get_item_vector(0)
-        return len(v0)
+        return self._index.f
 
     def __repr__(self):
         """String representation"""
@@ -173,30 +739,42 @@ class AnnoyIndexReader:
         """Initialize
         """
 
-    def read_from_files(self, ann_file: str, json_file: str, name=None):
+    def read_from_files(
+        self, ann_file: str, json_file: str, name=None, labels_file: str = None
+    ):
         """
         Args:
             ann_file (path): Annoy index file
-            json_file (path): Contains metadata (including labels) for indexed vectors
+            json_file (path): Contains metadata (and, for older indexes,
+                labels) for indexed vectors
             name (str, optional): Index's name
+            labels_file (path, optional): `.labels.npy` file to read labels
+                from, by default the one next to the index file (if any)
 
         Returns:
             annoy.AnnoyIndex: Index
+
+        Raises:
+            ValueError: If the index's labels cannot be found
         """
         metadata = self._read_json(json_file)
-        item_resolver = metadata["labels"].__getitem__
+        labels = find_labels(metadata, ann_file, labels_file)
         dims = metadata["dims"]
         metric = metadata["metric"]
         index = self._read_ann(ann_file, dims=dims, metric=metric)
-        return AnnoyIndex(index, item_resolver, name)
+        return AnnoyIndex(index, labels, name)
 
     def _read_ann(self, ann_file: str, dims: int, metric: str):
-        """Load index file"""
+        """Load index file
+
+        The file is memory-mapped without prefaulting, so tree nodes are paged
+        in on demand and the page cache is shared between processes
+        """
         index = annoy.AnnoyIndex(dims, metric)
-        index.load(ann_file)
+        index.load(ann_file, prefault=False)
         return index
 
     def _read_json(self, json_file: str):
         """Read metdata file"""
-        with open(json_file) as file:
-            return json.load(file)
+        with open(json_file, "rb") as file:
+            return orjson.loads(file.read())
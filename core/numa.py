@@ -0,0 +1,37 @@
+"""NUMA memory placement
+
+On machines with several NUMA nodes (e.g. dual-socket servers), memory is by
+default allocated on the node of the CPU that first touches it, so all the
+index pages read by the loading threads may end up on one node and every
+query running on the other node reads them remotely. Interleaving spreads
+the pages over all nodes instead.
+"""
+
+import ctypes
+import ctypes.util
+
+
+def interleave_memory() -> bool:
+    """Interleave the process's future memory allocations (including the
+    index files' pages) over all NUMA nodes using `libnuma`
+
+    Equivalent to starting the process with `numactl --interleave=all`, it
+    has to be called before the indexes are read.
+
+    Returns:
+        bool: True if the policy was set, False if `libnuma` is unavailable
+            or the system has no NUMA support
+    """
+    lib_name = ctypes.util.find_library("numa")
+    if lib_name is None:
+        return False
+    try:
+        libnuma = ctypes.CDLL(lib_name)
+    except OSError:
+        return False
+    if libnuma.numa_available() < 0:
+        return False
+    all_nodes = ctypes.c_void_p.in_dll(libnuma, "numa_all_nodes_ptr")
+    libnuma.numa_set_interleave_mask.argtypes = [ctypes.c_void_p]
+    libnuma.numa_set_interleave_mask(all_nodes)
+    return True
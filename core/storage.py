@@ -2,10 +2,14 @@
 Class to store index
 """
 import os
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from core.indexes import FaissIndexReader, AnnoyIndexReader
 import psutil
 
 CHECK_MARK = "\u2713"
+MAX_LOADING_THREADS = 8
 USE_FAISS_INDEXES = os.environ["USE_FAISS_INDEXES"]
 USE_ANNOY_INDEXES = os.environ["USE_ANNOY_INDEXES"]
 
@@ -21,30 +25,46 @@ class IndexStorage:
 
     cache = {}
     metric = "angular"
+    _cache_lock = threading.Lock()
+    _loading_locks = {}
 
-    def __init__(self, folder):
+    def __init__(self, folder, on_load=None):
         """Initialize
 
         Args:
             folder (path): Directory path where indexes are stored
+            on_load (callable, optional): Called with each index once, right
+                after it is read from disk (e.g. to apply search settings)
         """
         self._folder = folder
-        self._available = self._discover_indexes()
+        self._on_load = on_load
+        self._file_names = {f.name for f in os.scandir(folder)}
+        self._index_files = self._discover_indexes()
+        self._available = set(self._index_files)
+        self._sorted_available = sorted(self._available)
 
     def _discover_indexes(self):
-        """Scan the directory to find indexes
+        """Find indexes among the directory's files (listed once, when the
+        storage is created)
 
         Returns:
-            set: A set of index identifiers (names)
+            dict: Index identifiers (names) -> index file names, a FAISS index
+                is preferred over an Annoy index with the same name
         """
-        files = list(os.scandir(self._folder))
-        index_files = []
+        extensions = []
         if USE_FAISS_INDEXES:
-            index_files += [f for f in files if f.name.endswith(".faiss")]
+            extensions.append(".faiss")
         if USE_ANNOY_INDEXES:
-            index_files += [f for f in files if f.name.endswith(".ann")]
-        index_ids = [".".join(f.name.split(".")[:-1]) for f in index_files]
-        return set(index_ids)
+            extensions.append(".ann")
+        extensions = tuple(extensions)
+        index_files = {}
+        for file_name in self._file_names:
+            if not file_name.endswith(extensions):
+                continue
+            index_id, extension = file_name.rsplit(".", 1)
+            if extension == "faiss" or index_id not in index_files:
+                index_files[index_id] = file_name
+        return index_files
 
     def get(self, index_id):
         """Get an index by name
@@ -55,41 +75,109 @@ class IndexStorage:
         Returns:
             list: An array of indexes matching `index_id`
         """
-        index_ids = [i for i in self.available() if i.startswith(index_id)]
+        index_ids = self._names_with_prefix(index_id)
         indexes = [self._get_one_index(i) for i in index_ids]
         return indexes
 
+    def _names_with_prefix(self, prefix):
+        """Find index names starting with `prefix` with a binary search over
+        the sorted names, i.e., in O(log K + matches) time"""
+        names = self._sorted_available
+        matches = []
+        for i in range(bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            matches.append(names[i])
+        return matches
+
+    def get_all(self):
+        """Get all available indexes
+
+        Indexes are read from disk in parallel (reading releases the GIL)
+
+        Returns:
+            list: Index objects, in order of their names
+        """
+        index_ids = self._sorted_available
+        n_threads = max(1, min(MAX_LOADING_THREADS, len(index_ids)))
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            return list(pool.map(self._get_one_index, index_ids))
+
     def _get_one_index(self, index_id):
-        """Get one index by name (either from cache or disk)"""
+        """Get one index by name (either from cache or disk)
+
+        An index is read from disk only once, even if several threads ask
+        for it at the same time; the others wait for it to be loaded.
+        """
         if index_id in self.cache:
             return self.cache.get(index_id)
-        return self._get_from_disk(index_id)
+        with self._cache_lock:
+            lock = self._loading_locks.setdefault(index_id, threading.Lock())
+        with lock:
+            if index_id in self.cache:
+                return self.cache.get(index_id)
+            return self._get_from_disk(index_id)
 
     def _get_from_disk(self, index_id):
         """Load an index from disk"""
         print(f"Loading vector index: {index_id}")
         index_file = self._get_index_file_path(index_id)
         json_file = f"{self._folder}/{index_id}.metadata.json"
+        labels_file = self._get_labels_file_path(index_id)
         if index_file.endswith("faiss"):
             reader = FaissIndexReader()
         else:
             reader = AnnoyIndexReader()
-        index = reader.read_from_files(index_file, json_file, name=index_id)
+        index = reader.read_from_files(
+            index_file, json_file, name=index_id, labels_file=labels_file
+        )
+        if self._on_load is not None:
+            self._on_load(index)
         self._cache_index(index_id, index)
         print(
             f"  {CHECK_MARK} RAM usage: {psutil.virtual_memory()._asdict().get('percent')}%"
         )
         return index
 
+    def prefetch(self, index_id):
+        """Ask the OS to read an index's files into the page cache in the
+        background, so that the first searches of the (memory-mapped) index
+        don't wait for disk reads. Does nothing where unsupported.
+
+        Args:
+            index_id (str): Index's name
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        paths = [
+            self._get_index_file_path(index_id),
+            self._get_labels_file_path(index_id),
+        ]
+        for path in paths:
+            if path is None:
+                continue
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
     def _get_index_file_path(self, index_id):
-        """Get full paths to index file"""
-        ann_file = f"{self._folder}/{index_id}.ann"
-        faiss_file = f"{self._folder}/{index_id}.faiss"
-        return faiss_file if (os.path.exists(faiss_file)) else ann_file
+        """Get full path to index file"""
+        return f"{self._folder}/{self._index_files[index_id]}"
+
+    def _get_labels_file_path(self, index_id):
+        """Get full path to the index's `.labels.npy` file (None if it
+        doesn't have one)"""
+        file_name = f"{index_id}.labels.npy"
+        if file_name not in self._file_names:
+            return None
+        return f"{self._folder}/{file_name}"
 
     def _cache_index(self, index_id, index):
         """Store the index in cache"""
-        self.cache[index_id] = index
+        with self._cache_lock:
+            self.cache[index_id] = index
 
     def available(self):
         """Get a list of index names available in the directory
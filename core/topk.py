@@ -0,0 +1,79 @@
+"""Functions for combining search results of several indexes
+"""
+
+import numpy as np
+
+
+def merge_topk(dists: np.ndarray, ids: np.ndarray, shards: np.ndarray, n: int):
+    """Find the `n` results with the smallest distances across indexes
+
+    Results are kept as parallel arrays (distances, ids, shards) rather than
+    tuples. Partitioning the distances selects the winners in linear time,
+    after which only those `n` entries are sorted.
+
+    Args:
+        dists (np.ndarray): Distances returned by all indexes, concatenated
+        ids (np.ndarray): Item ids (local to each index), -1 marks a missing
+            result
+        shards (np.ndarray): Position of the index that returned each result
+        n (int): No. of results to return
+
+    Returns:
+        tuple: `(shards, ids, dists)` arrays of the (at most) `n` best
+            results, in ascending order of distance
+    """
+    return merge_topk_rows(dists[np.newaxis], ids[np.newaxis], shards, n)[0]
+
+
+def merge_topk_rows(dists: np.ndarray, ids: np.ndarray, shards: np.ndarray, n: int):
+    """Row-wise `merge_topk` for the results of a batch of queries
+
+    The top `n` of all rows are selected and sorted together (along axis 1),
+    so the cost of a batch is not paid row by row in Python.
+
+    Args:
+        dists (np.ndarray): `(m, T)` matrix, row `i` has the distances
+            returned by all indexes for the `i`-th query, concatenated
+        ids (np.ndarray): `(m, T)` matrix of item ids (local to each index),
+            -1 marks a missing result
+        shards (np.ndarray): `(T,)` array, position of the index that
+            returned each column
+        n (int): No. of results to return per query
+
+    Returns:
+        list: A `(shards, ids, dists)` tuple for each query (as returned by
+            `merge_topk`)
+    """
+    dists = np.where(ids >= 0, dists, np.inf)
+    k = min(n, dists.shape[1])
+    if k <= 0:
+        return [(shards[:0], row[:0], dists[0, :0]) for row in ids]
+    top = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(dists, top, axis=1), axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_ids = np.take_along_axis(ids, top, axis=1)
+    top_dists = np.take_along_axis(dists, top, axis=1)
+    top_shards = shards[top]
+    merged = []
+    for row_shards, row_ids, row_dists in zip(top_shards, top_ids, top_dists):
+        found = row_ids >= 0
+        merged.append((row_shards[found], row_ids[found], row_dists[found]))
+    return merged
+
+
+def group_by_shard(shards: np.ndarray, ids: np.ndarray):
+    """Group item ids by the index they belong to
+
+    Args:
+        shards (np.ndarray): Index positions, as returned by `merge_topk`
+        ids (np.ndarray): Item ids, as returned by `merge_topk`
+
+    Returns:
+        dict: Index position -> `(positions, ids)`, where `positions` are the
+            places of the items in the input arrays
+    """
+    groups = {}
+    for shard in np.unique(shards).tolist():
+        positions = np.flatnonzero(shards == shard)
+        groups[shard] = (positions, ids[positions])
+    return groups
@@ -2,23 +2,34 @@
 Attributes:
     app (fastapi.applications.FastAPI): FastAPI instance
     PORT (int): Port number
+    WORKERS (int): No. of server processes
 """
 
 import os
-import json
+import gc
+import base64
+import asyncio
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import dotenv
-from operator import add
-from functools import reduce
+import numpy as np
+import orjson
+import faiss
 import uvicorn
 from uvicorn.config import LOGGING_CONFIG
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional, Tuple
 
 dotenv.load_dotenv()
 
 from core.storage import IndexStorage
+from core.indexes import VectorIndex, FaissIndex, combine_faiss_indexes
+from core.topk import merge_topk_rows, group_by_shard
+from core.cache import QueryCache, DEFAULT_CACHE_SIZE
+from core.numa import interleave_memory
 
 LOGGING_FORMAT = "%(levelprefix)s %(client_addr)s %(status_code)s"
 LOGGING_CONFIG["formatters"]["access"]["fmt"] = LOGGING_FORMAT
@@ -26,31 +37,387 @@ LOGGING_CONFIG["formatters"]["access"]["fmt"] = LOGGING_FORMAT
 APP_DIR = Path(__file__).parent
 INDEXES_FOLDER = (APP_DIR / "indexes").resolve()
 assert os.path.isdir(INDEXES_FOLDER), f"Cannot find indexes directory: {INDEXES_FOLDER}"
-index_storage = IndexStorage(INDEXES_FOLDER)
-indexes = reduce(add, [index_storage.get(name) for name in index_storage.available()])
+# Spread the indexes' memory over all NUMA nodes (must precede loading them)
+if os.environ.get("NUMA_INTERLEAVE"):
+    interleave_memory()
+
+# Indexes are loaded when the server starts unless PRELOAD_INDEXES=0, in which
+# case each one is loaded (memory-mapped) when it is first searched, or
+# PRELOAD_INDEXES=import, in which case they are loaded as soon as this module
+# is imported (see below)
+PRELOAD_INDEXES = os.environ.get("PRELOAD_INDEXES", "1")
+# Read the whole index files into the page cache when preloading them (only
+# useful if they fit in RAM)
+PREFETCH_INDEXES = os.environ.get("PREFETCH_INDEXES", "0") == "1"
+WARMUP_BATCH_SIZE = 8
+# Search depth of HNSW (FAISS) indexes, stored in the indexes themselves so
+# searches don't need per-call parameters
+EF_SEARCH = os.environ.get("EF_SEARCH")
+# Batches of at least this many queries are searched on the GPU(s), if any
+GPU_BATCH_THRESHOLD = int(os.environ.get("GPU_BATCH_THRESHOLD", 64))
+
+
+def configure(idx: VectorIndex):
+    """Apply the search settings to an index (once, when it is loaded)"""
+    if EF_SEARCH and isinstance(idx, FaissIndex) and idx.ef_search is not None:
+        idx.ef_search = int(EF_SEARCH)
+
+
+index_storage = IndexStorage(INDEXES_FOLDER, on_load=configure)
+n_indexes = len(index_storage.available())
+
+_search_targets = None
+_search_targets_lock = threading.Lock()
+
+
+def get_target_indexes(index: Optional[str] = None) -> List[VectorIndex]:
+    """Get the indexes to search (loading them on first use): all of them,
+    with compatible FAISS indexes combined, or those whose names start with
+    `index`"""
+    global _search_targets
+    if index is not None:
+        return index_storage.get(index)
+    with _search_targets_lock:
+        if _search_targets is None:
+            _search_targets = combine_faiss_indexes(index_storage.get_all())
+            if faiss.get_num_gpus() > 0:
+                for idx in _search_targets:
+                    if isinstance(idx, FaissIndex):
+                        idx.enable_gpu(GPU_BATCH_THRESHOLD)
+    return _search_targets
+
+
+def warm_up():
+    """Load the indexes and run a few searches on each of them, so that the
+    first requests don't pay for FAISS's one-time initialization or for
+    reading the most used parts of the indexes (e.g. coarse quantizers) from
+    disk"""
+    if PREFETCH_INDEXES:
+        for name in index_storage.available():
+            index_storage.prefetch(name)
+    for idx in get_target_indexes():
+        qvecs = np.random.randn(WARMUP_BATCH_SIZE, idx.dims()).astype(np.float32)
+        idx.search_batch(qvecs, 10)
+
+
+if PRELOAD_INDEXES == "import":
+    # Read the indexes before a forking server (`gunicorn --preload`) starts
+    # its workers, so that they all share one copy of them. Frozen objects
+    # are left alone by the garbage collector, which would otherwise write to
+    # (and so copy) their memory pages in every worker
+    index_storage.get_all()
+    gc.freeze()
+
+
+# Search targets (see `get_target_indexes`) are searched in parallel, for each
+# of the concurrently served requests, so the cores are split between those
+# searches to keep FAISS's own OpenMP threads from oversubscribing the CPU
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", 1))
+WORKERS = int(os.environ.get("WORKERS", 1))
+search_pool = None
+
+
+def omp_threads(n_targets: int) -> int:
+    """No. of OpenMP threads for each of `n_targets` parallel searches"""
+    parallel_searches = max(1, n_targets) * SEARCH_CONCURRENCY * WORKERS
+    return max(1, os.cpu_count() // parallel_searches)
+
+
+# Dimensionality of the query vectors (optional), lets malformed queries be
+# rejected without knowing (or loading) the indexes
+VECTOR_DIMS = int(os.environ["VECTOR_DIMS"]) if os.environ.get("VECTOR_DIMS") else None
+
+# Largest no. of results that can be asked for per query
+MAX_K = int(os.environ.get("MAX_K", 200))
+
+# Results of recent single-vector searches, repeated queries skip the indexes
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+query_cache = QueryCache(QUERY_CACHE_SIZE)
+
+# Responses are encoded with orjson (which also serializes NumPy arrays)
+app = FastAPI(default_response_class=ORJSONResponse)
+
+
+@app.on_event("startup")
+async def preload_indexes():
+    """Load and warm up all the indexes before serving requests (see
+    `PRELOAD_INDEXES`)"""
+    if PRELOAD_INDEXES != "0":
+        await asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+
+@app.on_event("startup")
+async def use_search_pool():
+    """Make the search pool, with room for the parallel searches of all the
+    concurrent requests, the event loop's default executor, so that any other
+    blocking work offloaded with `run_in_executor(None, ...)` shares its
+    (bounded) threads instead of a second pool
+
+    The pool is sized from the no. of search targets if the indexes have been
+    preloaded, otherwise from the no. of index files (an upper bound)."""
+    global search_pool
+    n_targets = len(_search_targets) if _search_targets is not None else n_indexes
+    search_pool = ThreadPoolExecutor(max_workers=max(1, n_targets) * SEARCH_CONCURRENCY)
+    asyncio.get_running_loop().set_default_executor(search_pool)
+
+
+B64_PREFIX = "b64:"
+
+
+def decode_vector(raw: bytes) -> np.ndarray:
+    """Decode a vector from its little-endian float32 bytes (zero-copy)"""
+    try:
+        return np.frombuffer(raw, dtype="<f4")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid binary query")
+
+
+def decode_b64_vector(encoded: str) -> np.ndarray:
+    """Decode a vector sent as base64 encoded little-endian float32 values"""
+    try:
+        raw = base64.b64decode(encoded, validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid base64 query")
+    return decode_vector(raw)
+
+
+def parse_query(query: str) -> np.ndarray:
+    """Decode a query vector sent either as a JSON array or, when prefixed
+    with `b64:`, as base64 encoded little-endian float32 values (the latter
+    is decoded without any per-element conversion)"""
+    if query.startswith(B64_PREFIX):
+        return decode_b64_vector(query[len(B64_PREFIX) :])
+    try:
+        qvec = np.asarray(orjson.loads(query), dtype=np.float32)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid JSON query")
+    if qvec.ndim != 1:
+        raise HTTPException(status_code=400, detail="Invalid JSON query")
+    return qvec
+
+
+def check_finite(qvecs: np.ndarray):
+    """Reject query vectors with infinite or NaN values"""
+    if not np.isfinite(qvecs).all():
+        raise HTTPException(status_code=400, detail="Query vector must be finite")
+
+
+def check_n(n: int):
+    """Reject requests for no results or for more than `MAX_K` results"""
+    if not 1 <= n <= MAX_K:
+        detail = f"n must be between 1 and {MAX_K}"
+        raise HTTPException(status_code=400, detail=detail)
+
+
+def check_nprobe(nprobe: Optional[int]):
+    """Reject requests for visiting less than one inverted list"""
+    if nprobe is not None and nprobe < 1:
+        raise HTTPException(status_code=400, detail="nprobe must be at least 1")
+
+
+def check_vector_dims(n_dims: int):
+    """Reject query vectors that don't have `VECTOR_DIMS` dimensions (if set)"""
+    if VECTOR_DIMS is not None and n_dims != VECTOR_DIMS:
+        detail = f"Query vector must have {VECTOR_DIMS} dimensions"
+        raise HTTPException(status_code=400, detail=detail)
+
+
+def check_dims(n_dims: int, target_indexes: List[VectorIndex]):
+    """Reject query vectors that don't match the indexes' dimensionality"""
+    for idx in target_indexes:
+        if n_dims != idx.dims():
+            detail = f"Query vector must have {idx.dims()} dimensions"
+            raise HTTPException(status_code=400, detail=detail)
+
+
+def normalize_once(
+    qvecs: np.ndarray, target_indexes: List[VectorIndex]
+) -> Optional[np.ndarray]:
+    """Return unit length copies of the query vectors if any of the FAISS
+    indexes expects them (None otherwise), so that they are normalized once
+    rather than by every index"""
+    if not any(
+        isinstance(idx, FaissIndex) and idx.normalize_queries
+        for idx in target_indexes
+    ):
+        return None
+    normalized = np.array(qvecs, dtype=np.float32, order="C")
+    faiss.normalize_L2(normalized)
+    normalized.setflags(write=False)
+    return normalized
+
+
+def search_index(
+    idx: VectorIndex,
+    qvecs: np.ndarray,
+    normalized: Optional[np.ndarray],
+    n: int,
+    nprobe: Optional[int] = None,
+    n_threads: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Search one index, passing `nprobe` and the normalized queries on to
+    FAISS indexes, using `n_threads` OpenMP threads (a per-thread setting, so
+    it is applied in the thread doing the search)"""
+    if n_threads is not None:
+        faiss.omp_set_num_threads(n_threads)
+    if not isinstance(idx, FaissIndex):
+        return idx.search_batch(qvecs, n)
+    if idx.normalize_queries:
+        return idx.search_batch(normalized, n, nprobe, pre_normalized=True)
+    return idx.search_batch(qvecs, n, nprobe)
+
+
+def merge_results(
+    target_indexes: List[VectorIndex],
+    per_index_results: List[Tuple[np.ndarray, np.ndarray]],
+    n: int,
+) -> List[List[Tuple[str, float]]]:
+    """Combine the `(ids, dists)` found by each index for a batch of queries
+    into the overall top `n` (label, distance) pairs of every query"""
+    ids = np.concatenate([ns for ns, _ in per_index_results], axis=1)
+    dists = np.concatenate([ds for _, ds in per_index_results], axis=1)
+    sizes = [ns.shape[1] for ns, _ in per_index_results]
+    shards = np.repeat(np.arange(len(sizes)), sizes)
+    results = []
+    for shards_, ids_, dists_ in merge_topk_rows(dists, ids, shards, n):
+        labels = [""] * len(ids_)
+        for shard, (positions, shard_ids) in group_by_shard(shards_, ids_).items():
+            shard_labels = target_indexes[shard].resolve(shard_ids)
+            for pos, label in zip(positions.tolist(), shard_labels):
+                labels[pos] = label
+        results.append(list(zip(labels, dists_.tolist())))
+    return results
+
+
+async def search_indexes(
+    qvecs: np.ndarray, n: int, index: Optional[str], nprobe: Optional[int]
+) -> List[List[Tuple[str, float]]]:
+    """Search the indexes (all, or those whose names start with `index`) in
+    parallel, each one with the whole batch of query vectors at once, and
+    return the top `n` results for every query"""
+    check_n(n)
+    check_nprobe(nprobe)
+    check_vector_dims(qvecs.shape[1])
+    loop = asyncio.get_running_loop()
+    target_indexes = await loop.run_in_executor(None, get_target_indexes, index)
+    check_dims(qvecs.shape[1], target_indexes)
+    # One contiguous float32 copy of the queries (none if they already are)
+    # is shared by all the indexes, read-only so that no index modifies it
+    qvecs = np.ascontiguousarray(qvecs, dtype=np.float32)
+    qvecs.setflags(write=False)
+    normalized = normalize_once(qvecs, target_indexes)
+    n_threads = omp_threads(len(target_indexes))
+    per_index_results = await asyncio.gather(
+        *[
+            loop.run_in_executor(
+                None, search_index, idx, qvecs, normalized, n, nprobe, n_threads
+            )
+            for idx in target_indexes
+        ]
+    )
+    if not per_index_results:
+        return [[] for _ in range(len(qvecs))]
+    return merge_results(target_indexes, per_index_results, n)
+
+
+async def run_search(
+    qvec: np.ndarray, n: int, index: Optional[str], nprobe: Optional[int]
+):
+    """Search for a single query vector and respond with the top `n` results"""
+    check_finite(qvec)
+    key = QueryCache.key(qvec, n, index, nprobe)
+    results = query_cache.get(key)
+    if results is None:
+        [results] = await search_indexes(qvec.reshape(1, -1), n, index, nprobe)
+        query_cache.put(key, results)
+    return ORJSONResponse({"query": qvec, "results": results})
 
-app = FastAPI()
 
 @app.get("/search")
-async def search(mode: str, query: str, n: Optional[int] = 10, index: Optional[str] = None):
-    """Converts the query into vector and returns top n similar indexes"""
-
-    if mode == "vector":
-        try:
-            qvec = json.loads(query)
-            if index is None:
-                target_indexes = indexes
-            else:
-                target_indexes = index_storage.get(index)
-            results = reduce(add, [idx.search(qvec, n) for idx in target_indexes])
-            results.sort(key=lambda r: r[1])
-            return {"query": qvec, "results": results[:n]}
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=400, detail="Invalid JSON query")
-    else:
+async def search(
+    mode: str,
+    query: Optional[str] = None,
+    n: Optional[int] = 10,
+    index: Optional[str] = None,
+    nprobe: Optional[int] = None,
+    query_b64: Optional[str] = None,
+):
+    """Converts the query into vector and returns top n similar indexes
+
+    The query vector is given either as `query` or, in base64 encoded
+    little-endian float32 bytes, as `query_b64`. `nprobe` trades speed for
+    recall on IVF (FAISS) indexes
+    """
+
+    if mode != "vector":
         raise HTTPException(status_code=400, detail="Invalid search mode")
 
+    if query_b64 is not None:
+        qvec = decode_b64_vector(query_b64)
+    elif query is not None:
+        qvec = parse_query(query)
+    else:
+        raise HTTPException(status_code=400, detail="Missing query")
+    return await run_search(qvec, n, index, nprobe)
+
+
+@app.post("/search")
+async def search_binary(
+    request: Request,
+    n: Optional[int] = 10,
+    index: Optional[str] = None,
+    nprobe: Optional[int] = None,
+):
+    """Same as `GET /search` but the query vector is sent as the request body
+    in raw little-endian float32 bytes (`application/octet-stream`)"""
+    if request.headers.get("content-type") != "application/octet-stream":
+        raise HTTPException(
+            status_code=415, detail="Expected an application/octet-stream body"
+        )
+    qvec = decode_vector(await request.body())
+    return await run_search(qvec, n, index, nprobe)
+
+
+@app.post("/search_batch")
+async def search_batch(request: Request):
+    """Searches for several query vectors at once
+
+    The JSON body has the form `{"queries": [[...], ...], "n": 10}`, with
+    optional `index` and `nprobe` fields (see `GET /search`). The response
+    has a list of results for each query, in order.
+    """
+    try:
+        body = orjson.loads(await request.body())
+        qvecs = np.ascontiguousarray(body["queries"], dtype=np.float32)
+        n = int(body.get("n", 10))
+        index = body.get("index")
+        nprobe = body.get("nprobe")
+        if index is not None and not isinstance(index, str):
+            raise TypeError("index must be a string")
+        if nprobe is not None and (
+            type(nprobe) is not int or nprobe < 1  # bools are ints too
+        ):
+            raise ValueError("nprobe must be a positive integer")
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if qvecs.ndim != 2 or len(qvecs) == 0:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    check_finite(qvecs)
+    results = await search_indexes(qvecs, n, index, nprobe)
+    return ORJSONResponse({"results": results})
+
 
 if __name__ == "__main__":
     port = int(os.environ["PORT"])
-    uvicorn.run("main:app", host="127.0.0.1", port=port, reload=False)
+    # Auto-reload (which can't be combined with several workers) is only
+    # meant for development
+    dev_mode = bool(os.environ.get("DEV"))
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=1 if dev_mode else WORKERS,
+        reload=dev_mode,
+    )
@@ -0,0 +1,62 @@
+"""Tests for the search results cache
+"""
+import unittest
+import sys
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = str(Path(__file__).parent.parent.resolve())
+sys.path.append(BASE_DIR)
+
+from core.cache import QueryCache
+
+
+class TestQueryCache(unittest.TestCase):
+    """Tests for the `QueryCache` class"""
+
+    def setUp(self):
+        """Create a cache with room for two entries"""
+        self.cache = QueryCache(2)
+        self.qvecs = np.random.random((3, 16)).astype("float32")
+
+    def test_get_stored_results(self):
+        """Are results found for the same query and parameters only?"""
+        self.cache.put(QueryCache.key(self.qvecs[0], 10), ["a"])
+        self.assertEqual(["a"], self.cache.get(QueryCache.key(self.qvecs[0], 10)))
+        self.assertIsNone(self.cache.get(QueryCache.key(self.qvecs[0], 5)))
+        self.assertIsNone(self.cache.get(QueryCache.key(self.qvecs[1], 10)))
+
+    def test_close_vectors_do_not_share_an_entry(self):
+        """Are vectors differing by less than their typical spread kept apart?"""
+        qvec = np.full(16, 0.05, dtype="float32")
+        self.cache.put(QueryCache.key(qvec), ["a"])
+        close = qvec.copy()
+        close[0] += 1e-4
+        self.assertIsNone(self.cache.get(QueryCache.key(close)))
+
+    def test_same_values_share_an_entry(self):
+        """Do equal vectors of other dtypes share an entry?"""
+        self.cache.put(QueryCache.key(self.qvecs[0]), ["a"])
+        as_list = self.qvecs[0].tolist()
+        self.assertEqual(["a"], self.cache.get(QueryCache.key(as_list)))
+
+    def test_evicts_least_recently_used(self):
+        """Is the least recently used entry dropped when full?"""
+        keys = [QueryCache.key(qvec) for qvec in self.qvecs]
+        self.cache.put(keys[0], ["a"])
+        self.cache.put(keys[1], ["b"])
+        self.cache.get(keys[0])
+        self.cache.put(keys[2], ["c"])
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertEqual(["a"], self.cache.get(keys[0]))
+
+    def test_disabled_cache(self):
+        """Does a cache of size 0 store nothing?"""
+        cache = QueryCache(0)
+        cache.put(QueryCache.key(self.qvecs[0]), ["a"])
+        self.assertEqual(0, len(cache))
+
+
+if __name__ == "__main__":
+    unittest.main()
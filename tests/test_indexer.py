@@ -4,6 +4,7 @@
 
 import unittest
 import os
+import json
 from pathlib import Path
 import sys
 import numpy as np
@@ -13,6 +14,7 @@ BASE_DIR = str(Path(__file__).parent.parent.resolve())
 sys.path.append(BASE_DIR)
 
 from core.indexer import FaissIndexCreator
+from core.indexes import FaissIndexReader
 
 
 class TestFaissIndexCreator(unittest.TestCase):
@@ -34,7 +36,7 @@ class TestFaissIndexCreator(unittest.TestCase):
         self.assertFalse(os.path.exists(index_file))
         self.assertFalse(os.path.exists(config_file))
 
-        options = {"normalize": True, "factory_string": "OPQ16_64,HNSW32"}
+        options = {"normalize": True, "factory_string": "OPQ16_64,IVF{nlist},PQ16x4fsr"}
         creator = FaissIndexCreator(**options)
         index = creator.create(
             name=self.index_name,
@@ -48,7 +50,7 @@ class TestFaissIndexCreator(unittest.TestCase):
         self.cleanup()
 
     def test__error_if_labels_vectors_mismatch(self):
-        options = {"normalize": True, "factory_string": "OPQ16_64,HNSW32"}
+        options = {"normalize": True, "factory_string": "OPQ16_64,IVF{nlist},PQ16x4fsr"}
         creator = FaissIndexCreator(**options)
         attempt = lambda: creator.create(
             name=self.index_name,
@@ -59,13 +61,88 @@ class TestFaissIndexCreator(unittest.TestCase):
         )
         self.assertRaises(Exception, attempt)
 
+    def test__error_if_too_few_training_vectors(self):
+        creator = FaissIndexCreator(factory_string="IVF4096,PQ16x4fsr")
+        attempt = lambda: creator.create(
+            name=self.index_name,
+            vectors=self.vectors,
+            labels=self.labels,
+            n_train=None,
+            save_dir=TEST_DIR,
+        )
+        self.assertRaises(AssertionError, attempt)
+
+    def test__nlist_placeholder_is_filled_in(self):
+        creator = FaissIndexCreator(factory_string="IVF{nlist},Flat", normalize=False)
+        creator.create(
+            name=self.index_name,
+            vectors=self.vectors,
+            labels=self.labels,
+            n_train=None,
+            save_dir=TEST_DIR,
+        )
+        config_file = f"{self.save_dir}/{self.index_name}.metadata.json"
+        with open(config_file) as fp:
+            config = json.load(fp)
+        self.assertEqual("IVF565,Flat", config["factory_string"])
+        self.cleanup()
+
+    def test__nlist_limited_by_training_vectors(self):
+        creator = FaissIndexCreator()
+        creator.create(
+            name=self.index_name,
+            vectors=self.vectors[:5000],
+            labels=self.labels[:5000],
+            n_train=None,
+            save_dir=TEST_DIR,
+        )
+        config_file = f"{self.save_dir}/{self.index_name}.metadata.json"
+        with open(config_file) as fp:
+            config = json.load(fp)
+        self.assertEqual("OPQ16_64,IVF166,PQ16x4fsr", config["factory_string"])
+        self.cleanup()
+
+    def test__small_index_is_flat(self):
+        creator = FaissIndexCreator()
+        creator.create(
+            name=self.index_name,
+            vectors=self.vectors[:100],
+            labels=self.labels[:100],
+            n_train=None,
+            save_dir=TEST_DIR,
+        )
+        config_file = f"{self.save_dir}/{self.index_name}.metadata.json"
+        with open(config_file) as fp:
+            config = json.load(fp)
+        self.assertEqual("Flat", config["factory_string"])
+        self.cleanup()
+
+    def test__fastscan_index_config(self):
+        creator = FaissIndexCreator(factory_string="IVF{nlist},PQ16x4fsr", nprobe=16)
+        creator.create(
+            name=self.index_name,
+            vectors=self.vectors,
+            labels=self.labels,
+            n_train=None,
+            save_dir=TEST_DIR,
+        )
+        config_file = f"{self.save_dir}/{self.index_name}.metadata.json"
+        with open(config_file) as fp:
+            config = json.load(fp)
+        self.assertTrue(config["fastscan"])
+        index = FaissIndexReader().read_from_files(
+            f"{self.save_dir}/{self.index_name}.faiss",
+            config_file,
+            labels_file=f"{self.save_dir}/{self.index_name}.labels.npy",
+        )
+        self.assertEqual(16, index.nprobe)
+        self.cleanup()
+
     def cleanup(self):
-        index_file = f"{self.save_dir}/{self.index_name}.faiss"
-        config_file = f"{self.save_dir}/{self.index_name}.config.json"
-        if os.path.exists(index_file):
-            os.remove(index_file)
-        if os.path.exists(config_file):
-            os.remove(config_file)
+        for ext in ("faiss", "config.json", "metadata.json", "labels.npy"):
+            path = f"{self.save_dir}/{self.index_name}.{ext}"
+            if os.path.exists(path):
+                os.remove(path)
 
 
 if __name__ == "__main__":
@@ -3,6 +3,11 @@
 import unittest
 import os
 import sys
+import json
+import shutil
+import tempfile
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import numpy as np
 
@@ -16,7 +21,11 @@ os.environ["USE_FAISS_INDEXES"] = "1"
 os.environ["USE_ANNOY_INDEXES"] = "1"
 
 
+import faiss
 from core.indexes import AnnoyIndexReader, AnnoyIndex, FaissIndexReader, FaissIndex
+from core.indexes import DEFAULT_NPROBE, FaissIndexShards, ShardedLabels
+from core.indexes import LabelArray, FASTSCAN_TYPES
+from core.indexes import combine_faiss_indexes
 from core.storage import IndexStorage
 
 
@@ -48,6 +57,16 @@ class TestAnnoyIndexClass(unittest.TestCase):
         self.assertIsInstance(results, list)
         self.assertEqual(n_results, len(results))
 
+    def test_run_batch_query(self):
+        """Can it search for several query vectors in one call?"""
+        qvecs = np.random.random((3, 768))
+        n_results = 10
+        ids, dists = self.index.search_batch(qvecs, n_results)
+        self.assertEqual((3, n_results), ids.shape)
+        self.assertEqual((3, n_results), dists.shape)
+        results = self.index.search(qvecs[1], n_results)
+        self.assertEqual([r[0] for r in results], self.index.resolve(ids[1]))
+
 
 class TestFaissIndexReaderClass(unittest.TestCase):
     """Test for reading the assets required for Faiss Indexer"""
@@ -60,6 +79,39 @@ class TestFaissIndexReaderClass(unittest.TestCase):
         index = r.read_from_files(index_file, json_file)
         self.assertIsInstance(index, FaissIndex)
 
+    def test_read_labels_from_npy_file(self):
+        """Can labels be read from a `.labels.npy` file?"""
+        index_file = f"{test_index_dir}/B68G.abs.faiss"
+        json_file = f"{test_index_dir}/B68G.abs.metadata.json"
+        with open(json_file) as fp:
+            labels = json.load(fp)["labels"]
+        qvec = np.ones(768)
+        r = FaissIndexReader()
+        expected = r.read_from_files(index_file, json_file).search(qvec, 10)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            labels_file = f"{tmp_dir}/B68G.abs.labels.npy"
+            np.save(labels_file, np.array([label.encode() for label in labels]))
+            index = r.read_from_files(index_file, json_file, labels_file=labels_file)
+            self.assertEqual(expected, index.search(qvec, 10))
+
+    def test_find_labels_file_next_to_index_file(self):
+        """Are labels read from the index's `.labels.npy` file by default?"""
+        with open(f"{test_index_dir}/B68G.abs.metadata.json") as fp:
+            metadata = json.load(fp)
+        labels = metadata.pop("labels")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = f"{tmp_dir}/B68G.abs.faiss"
+            json_file = f"{tmp_dir}/B68G.abs.metadata.json"
+            shutil.copy(f"{test_index_dir}/B68G.abs.faiss", index_file)
+            with open(json_file, "w") as fp:
+                json.dump(metadata, fp)
+            r = FaissIndexReader()
+            self.assertRaises(ValueError, r.read_from_files, index_file, json_file)
+            encoded = np.array([label.encode() for label in labels])
+            np.save(f"{tmp_dir}/B68G.abs.labels.npy", encoded)
+            index = r.read_from_files(index_file, json_file)
+            self.assertEqual(labels, index.resolve(np.arange(len(labels))))
+
 
 class TestFaissIndexClass(unittest.TestCase):
     """Tests for getting indexes from Faiss indexer"""
@@ -79,6 +131,214 @@ class TestFaissIndexClass(unittest.TestCase):
         self.assertIsInstance(results, list)
         self.assertEqual(n_results, len(results))
 
+    def test_run_batch_query(self):
+        """Can it search for several query vectors in one call?"""
+        qvecs = np.random.random((3, 768))
+        n_results = 10
+        ids, dists = self.index.search_batch(qvecs, n_results)
+        self.assertEqual((3, n_results), ids.shape)
+        self.assertEqual((3, n_results), dists.shape)
+        results = self.index.search(qvecs[1], n_results)
+        self.assertEqual([r[0] for r in results], self.index.resolve(ids[1]))
+
+    def test_query_is_not_modified(self):
+        """Normalizing the queries must not change the caller's array"""
+        qvecs = np.full((2, 768), 3, dtype="float32")
+        self.index.search_batch(qvecs, 10)
+        self.assertTrue(np.all(qvecs == 3))
+
+    def test_search_pre_normalized_query(self):
+        """Are queries normalized by the caller searched as they are?"""
+        qvec = np.random.random(768).astype("float32")
+        unit = qvec / np.linalg.norm(qvec)
+        expected = [label for label, _ in self.index.search(qvec, 10)]
+        results = self.index.search(unit, 10, pre_normalized=True)
+        self.assertEqual(expected, [label for label, _ in results])
+
+    def test_ef_search(self):
+        """Can the search depth of an HNSW index be changed?"""
+        self.index.ef_search = 64
+        self.assertEqual(64, self.index.ef_search)
+        self.assertEqual(10, len(self.index.search(np.ones(768), 10)))
+
+    def test_search_read_only_queries(self):
+        """Can queries shared as read-only arrays be searched?"""
+        qvecs = np.random.random((2, 768)).astype("float32")
+        qvecs.setflags(write=False)
+        ids, _ = self.index.search_batch(qvecs, 10)
+        self.assertEqual((2, 10), ids.shape)
+
+    def test_query_buffer_is_reused(self):
+        """Do searches reusing the query buffer return correct results?"""
+        qvecs = np.random.random((2, 768))
+        first = self.index.search(qvecs[0], 10)
+        self.index.search(qvecs[1], 10)
+        self.assertEqual(first, self.index.search(qvecs[0], 10))
+
+
+class TestFaissIVFIndex(unittest.TestCase):
+    """Tests for search parameters of IVF indexes"""
+
+    def setUp(self):
+        """Create a small in-memory IVF index"""
+        vectors = np.random.random((400, 16)).astype("float32")
+        index = faiss.index_factory(16, "IVF8,Flat")
+        index.train(vectors)
+        index.add(vectors)
+        labels = [str(i) for i in range(len(vectors))]
+        self.vectors = vectors
+        self.faiss_index = index
+        self.index = FaissIndex(index, labels, normalize_queries=False)
+
+    def test_default_nprobe(self):
+        """Is `nprobe` set to the default value?"""
+        self.assertEqual(DEFAULT_NPROBE, self.index.nprobe)
+
+    def test_parallel_over_inverted_lists(self):
+        """Are single queries parallelized over inverted lists?"""
+        self.assertEqual(1, self.faiss_index.parallel_mode)
+
+    def test_search_with_nprobe(self):
+        """Can `nprobe` be overridden for one search?"""
+        results = self.index.search(self.vectors[7], 5, nprobe=8)
+        self.assertEqual("7", results[0][0])
+        self.assertEqual(DEFAULT_NPROBE, self.index.nprobe)
+
+    def test_nprobe_capped_at_nlist(self):
+        """Is an `nprobe` above the no. of inverted lists searched as nlist?"""
+        self.assertEqual(8, self.index.nlist)
+        results = self.index.search(self.vectors[7], 5, nprobe=1 << 40)
+        self.assertEqual("7", results[0][0])
+
+    def test_concurrent_searches_with_different_nprobe(self):
+        """Does each of several concurrent searches use its own `nprobe`?"""
+        qvecs = np.random.random((4, 16)).astype("float32")
+        nprobes = [1, 2, 8, None] * 8
+        expected = {p: self.index.search_batch(qvecs, 10, p)[0] for p in nprobes}
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            search = lambda p: self.index.search_batch(qvecs, 10, p)[0]
+            results = list(pool.map(search, nprobes))
+        for nprobe, ids in zip(nprobes, results):
+            self.assertEqual(expected[nprobe].tolist(), ids.tolist())
+        self.assertEqual(DEFAULT_NPROBE, self.index.nprobe)
+
+    @unittest.skipIf(faiss.get_num_gpus() > 0, "GPU available")
+    def test_enable_gpu_without_gpus(self):
+        """Do searches stay on the CPU when there are no GPUs?"""
+        self.assertFalse(self.index.enable_gpu(2))
+        results = self.index.search_batch(self.vectors[:4], 1)[0]
+        self.assertEqual([0, 1, 2, 3], results[:, 0].tolist())
+
+    def test_no_ef_search(self):
+        """Is setting the HNSW search depth of an IVF index an error?"""
+        self.assertIsNone(self.index.ef_search)
+        self.assertRaises(ValueError, setattr, self.index, "ef_search", 64)
+
+
+@unittest.skipUnless(FASTSCAN_TYPES, "FAISS without FastScan indexes")
+class TestFaissFastScanIndex(unittest.TestCase):
+    """Tests for search parameters of IVF indexes with FastScan codes"""
+
+    def setUp(self):
+        """Create a small in-memory OPQ + IVF + PQ-FastScan index, the
+        default configuration of `FaissIndexCreator`"""
+        vectors = np.random.random((1000, 16)).astype("float32")
+        index = faiss.index_factory(16, "OPQ4_16,IVF8,PQ16x4fsr")
+        index.train(vectors)
+        index.add(vectors)
+        labels = [str(i) for i in range(len(vectors))]
+        self.vectors = vectors
+        self.index = FaissIndex(index, labels, normalize_queries=False)
+
+    def test_search_with_nprobe(self):
+        """Can `nprobe` be overridden for one search?"""
+        qvecs = self.vectors[:4]
+        ids = self.index.search_batch(qvecs, 5, nprobe=1)[0]
+        self.assertEqual(DEFAULT_NPROBE, self.index.nprobe)
+        self.index.nprobe = 1
+        self.assertEqual(self.index.search_batch(qvecs, 5)[0].tolist(), ids.tolist())
+
+
+class TestFaissIndexShards(unittest.TestCase):
+    """Tests for searching several FAISS indexes as one"""
+
+    def setUp(self):
+        """Split a set of vectors into two flat indexes"""
+        self.vectors = np.random.random((300, 16)).astype("float32")
+        self.parts = []
+        for i, part in enumerate([self.vectors[:100], self.vectors[100:]]):
+            index = faiss.IndexFlatL2(16)
+            index.add(part)
+            labels = [f"{i}-{j}" for j in range(len(part))]
+            self.parts.append(FaissIndex(index, labels, normalize_queries=False))
+
+    def test_search_across_shards(self):
+        """Are items found in any of the shards?"""
+        shards = FaissIndexShards(self.parts)
+        self.assertEqual("0-5", shards.search(self.vectors[5], 3)[0][0])
+        self.assertEqual("1-50", shards.search(self.vectors[150], 3)[0][0])
+
+    def test_error_if_indexes_differ(self):
+        """Are indexes of different dimensionality rejected?"""
+        other = FaissIndex(faiss.IndexFlatL2(8), [], normalize_queries=False)
+        attempt = lambda: FaissIndexShards(self.parts + [other])
+        self.assertRaises(ValueError, attempt)
+
+    def test_combine_compatible_indexes(self):
+        """Are only compatible FAISS indexes combined?"""
+        other = FaissIndex(faiss.IndexFlatL2(8), [], normalize_queries=False)
+        annoy_index = AnnoyIndexReader().read_from_files(
+            f"{test_index_dir}/Y02T.ttl.ann", f"{test_index_dir}/Y02T.ttl.metadata.json"
+        )
+        combined = combine_faiss_indexes(self.parts + [other, annoy_index])
+        self.assertEqual(3, len(combined))
+        self.assertIsInstance(combined[0], FaissIndexShards)
+        self.assertIs(other, combined[1])
+        self.assertIs(annoy_index, combined[2])
+
+    def test_ivf_indexes_not_combined_with_others(self):
+        """Are IVF indexes kept apart from flat indexes of the same kind?"""
+        vectors = np.random.random((400, 16)).astype("float32")
+        ivf_index = faiss.index_factory(16, "IVF8,Flat")
+        ivf_index.train(vectors)
+        ivf_index.add(vectors)
+        ivf = FaissIndex(ivf_index, [], normalize_queries=False)
+        combined = combine_faiss_indexes(self.parts + [ivf])
+        self.assertEqual(2, len(combined))
+        self.assertIsInstance(combined[0], FaissIndexShards)
+        self.assertIs(ivf, combined[1])
+
+    def test_search_ivf_shards_with_nprobe(self):
+        """Is `nprobe` applied to every IVF shard for one search?"""
+        parts = []
+        for i, part in enumerate([self.vectors[:150], self.vectors[150:]]):
+            index = faiss.index_factory(16, "IVF4,Flat")
+            index.train(part)
+            index.add(part)
+            labels = [f"{i}-{j}" for j in range(len(part))]
+            parts.append(FaissIndex(index, labels, normalize_queries=False))
+        shards = FaissIndexShards(parts)
+        qvecs = self.vectors[140:160]
+        ids = shards.search_batch(qvecs, 5, nprobe=1)[0]
+        self.assertEqual(DEFAULT_NPROBE, shards.nprobe)
+        shards.nprobe = 1
+        self.assertEqual(shards.search_batch(qvecs, 5)[0].tolist(), ids.tolist())
+        self.assertEqual(list(range(140, 160)), ids[:, 0].tolist())
+
+    def test_sharded_labels(self):
+        """Do global ids map to the right labels?"""
+        labels = ShardedLabels([["a", "b"], [], ["c"]])
+        self.assertEqual(["a", "b", "c"], [labels[i] for i in range(3)])
+        self.assertEqual(3, len(labels))
+
+    def test_sharded_labels_take(self):
+        """Are labels of several global ids gathered in order?"""
+        arrays = [np.array([b"a", b"b"]), np.array([], dtype="S1"), ["c", "d"]]
+        label_arrays = [LabelArray(arrays[0]), LabelArray(arrays[1]), arrays[2]]
+        labels = ShardedLabels(label_arrays)
+        ids = np.array([3, 0, 2, 1])
+        self.assertEqual(["d", "a", "c", "b"], labels.take(ids))
+
 
 class TestIndexStorage(unittest.TestCase):
     def setUp(self):
@@ -106,12 +366,80 @@ class TestIndexStorage(unittest.TestCase):
         indexes = self.get_index("Z007")
         self.assertEqual([], indexes)
 
+    def test_get_indexes_by_prefix(self):
+        """Are exactly the indexes with the given prefix returned?"""
+        names = [idx.name for idx in self.get_index("Y02T.")]
+        self.assertEqual(["Y02T.abs", "Y02T.npl", "Y02T.ttl"], names)
+        names = [idx.name for idx in self.get_index("Y02T.n")]
+        self.assertEqual(["Y02T.npl"], names)
+
     def test_available_indexes(self):
         """Discovers indexes on disk"""
         index_ids = self.indexes.available()
         self.assertIsInstance(index_ids, set)
         self.assertEqual(len(index_ids), 4)
 
+    def test_get_all_indexes(self):
+        """Loads every index exactly once"""
+        indexes = self.indexes.get_all()
+        self.assertEqual(4, len(indexes))
+        names = [idx.name for idx in indexes]
+        self.assertEqual(sorted(self.indexes.available()), names)
+
+    def test_faiss_index_preferred_over_annoy_index(self):
+        """Is the FAISS file used if an index has both a FAISS and an Annoy
+        file?"""
+        with tempfile.TemporaryDirectory() as folder:
+            for file_name in ["X.ann", "X.faiss", "Y.ann", "X.metadata.json"]:
+                Path(folder, file_name).touch()
+            storage = IndexStorage(folder)
+            self.assertEqual({"X", "Y"}, set(storage.available()))
+            self.assertEqual(f"{folder}/X.faiss", storage._get_index_file_path("X"))
+            self.assertEqual(f"{folder}/Y.ann", storage._get_index_file_path("Y"))
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise unsupported")
+    def test_prefetch_index_files(self):
+        """Are an index's file and labels file read ahead?"""
+        with tempfile.TemporaryDirectory() as folder:
+            for file_name in ["X.faiss", "X.metadata.json", "X.labels.npy"]:
+                Path(folder, file_name).touch()
+            storage = IndexStorage(folder)
+            with mock.patch("os.open", wraps=os.open) as open_file:
+                with mock.patch("os.posix_fadvise") as fadvise:
+                    storage.prefetch("X")
+        opened = [call.args[0] for call in open_file.call_args_list]
+        self.assertEqual([f"{folder}/X.faiss", f"{folder}/X.labels.npy"], opened)
+        self.assertEqual(2, fadvise.call_count)
+        for call in fadvise.call_args_list:
+            self.assertEqual(os.POSIX_FADV_WILLNEED, call.args[3])
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise unsupported")
+    def test_prefetch_skips_missing_labels_file(self):
+        """Is only the index file read ahead if there is no labels file?"""
+        with mock.patch("os.open", wraps=os.open) as open_file:
+            with mock.patch("os.posix_fadvise") as fadvise:
+                self.indexes.prefetch("B68G.abs")
+        opened = [call.args[0] for call in open_file.call_args_list]
+        self.assertEqual([f"{test_index_dir}/B68G.abs.faiss"], opened)
+        fadvise.assert_called_once()
+
+    def test_each_index_loaded_once(self):
+        """Is an index read (and set up) once when requested concurrently?"""
+        cached = dict(IndexStorage.cache)
+        IndexStorage.cache.clear()
+        loaded = []
+        try:
+            storage = IndexStorage(test_index_dir, on_load=loaded.append)
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                for _ in range(4):
+                    pool.submit(storage.get, "Y02T.")
+                pool.submit(storage.get_all)
+            names = sorted(idx.name for idx in loaded)
+            self.assertEqual(sorted(storage.available()), names)
+        finally:
+            IndexStorage.cache.clear()
+            IndexStorage.cache.update(cached)
+
     def get_index(self, index_code):
         """Get an index by its name"""
         index = self.indexes.get(index_code)
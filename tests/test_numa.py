@@ -0,0 +1,49 @@
+"""Tests for NUMA memory placement
+"""
+import unittest
+from unittest import mock
+import ctypes
+import sys
+from pathlib import Path
+
+BASE_DIR = str(Path(__file__).parent.parent.resolve())
+sys.path.append(BASE_DIR)
+
+from core.numa import interleave_memory
+
+
+class TestInterleaveMemory(unittest.TestCase):
+    def test_does_nothing_without_libnuma(self):
+        """Does it return False if libnuma cannot be found?"""
+        with mock.patch("ctypes.util.find_library", return_value=None):
+            with mock.patch("ctypes.CDLL") as cdll:
+                self.assertFalse(interleave_memory())
+        cdll.assert_not_called()
+
+    def test_does_nothing_without_numa_support(self):
+        """Does it return False if the system has no NUMA support?"""
+        libnuma = mock.Mock()
+        libnuma.numa_available.return_value = -1
+        with mock.patch("ctypes.util.find_library", return_value="libnuma.so.1"):
+            with mock.patch("ctypes.CDLL", return_value=libnuma):
+                self.assertFalse(interleave_memory())
+        libnuma.numa_set_interleave_mask.assert_not_called()
+
+    def test_interleaves_over_all_nodes(self):
+        """Is the interleave mask set to all nodes when libnuma is available?"""
+        libnuma = mock.Mock()
+        libnuma.numa_available.return_value = 0
+        all_nodes = ctypes.c_void_p(1234)
+        with mock.patch("ctypes.util.find_library", return_value="libnuma.so.1"):
+            with mock.patch("ctypes.CDLL", return_value=libnuma) as cdll:
+                with mock.patch.object(
+                    ctypes.c_void_p, "in_dll", return_value=all_nodes
+                ) as in_dll:
+                    self.assertTrue(interleave_memory())
+        cdll.assert_called_once_with("libnuma.so.1")
+        in_dll.assert_called_once_with(libnuma, "numa_all_nodes_ptr")
+        libnuma.numa_set_interleave_mask.assert_called_once_with(all_nodes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,12 @@
 """Test for service API
 """
 import unittest
+import os
 import json
+import base64
 import sys
 from pathlib import Path
+from unittest import mock
 import numpy as np
 from dotenv import load_dotenv
 from fastapi.testclient import TestClient
@@ -14,7 +17,9 @@ ENV_PATH = BASE_PATH / ".env"
 
 load_dotenv(ENV_PATH.as_posix())
 sys.path.append(BASE_PATH.as_posix())
+os.environ["VECTOR_DIMS"] = "384"
 
+import main
 from main import app
 
 class TestAPI(unittest.TestCase):
@@ -77,6 +82,114 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(400, r.status_code)
         self.assertEqual("Invalid JSON query", r.json().get("detail"))
     
+    def test__error_if_n_out_of_range(self):
+        query = json.dumps(np.random.random(384).tolist())
+        for n in (0, -1, 1 << 30):
+            params = {"mode": "vector", "query": query, "n": n}
+            r = self.client.get("/search", params=params)
+            self.assertEqual(400, r.status_code)
+
+    def test__error_if_nprobe_out_of_range(self):
+        query = json.dumps(np.random.random(384).tolist())
+        for nprobe in (0, -5):
+            params = {"mode": "vector", "query": query, "n": 5, "nprobe": nprobe}
+            r = self.client.get("/search", params=params)
+            self.assertEqual(400, r.status_code)
+
+    def test__can_search_with_base64_encoded_vector(self):
+        qvec = np.random.random(384).astype("<f4")
+        params = {
+            "mode": "vector",
+            "query": "b64:" + base64.b64encode(qvec.tobytes()).decode(),
+            "n": 5,
+        }
+        r = self.client.get("search", params=params)
+        self.assertEqual(200, r.status_code)
+
+        results = r.json().get("results")
+        self.followsJsonSchema(results, self.results_schema)
+
+    def test__can_search_with_query_b64_parameter(self):
+        qvec = np.random.random(384).astype("<f4")
+        params = {
+            "mode": "vector",
+            "query_b64": base64.b64encode(qvec.tobytes()).decode(),
+            "n": 5,
+        }
+        r = self.client.get("search", params=params)
+        self.assertEqual(200, r.status_code)
+
+        results = r.json().get("results")
+        self.followsJsonSchema(results, self.results_schema)
+
+    def test__error_if_query_missing(self):
+        r = self.client.get("/search", params={"mode": "vector", "n": 5})
+        self.assertEqual(400, r.status_code)
+        self.assertEqual("Missing query", r.json().get("detail"))
+
+    def test__invalid_base64_encoded_vector_in_request(self):
+        """Make sure HTTP 400 is returned when base64 encoded query vector is
+        not decodable
+        """
+        params = {"mode": "vector", "query": "b64:invalid!", "n": 5}
+        r = self.client.get("/search", params=params)
+        self.assertEqual(400, r.status_code)
+        self.assertEqual("Invalid base64 query", r.json().get("detail"))
+
+    def test__error_if_query_not_finite(self):
+        qvec = np.random.random(384).astype("<f4")
+        qvec[3] = np.inf
+        query = "b64:" + base64.b64encode(qvec.tobytes()).decode()
+        r = self.client.get("/search", params={"mode": "vector", "query": query})
+        self.assertEqual(400, r.status_code)
+        self.assertEqual("Query vector must be finite", r.json().get("detail"))
+        body = json.dumps({"queries": [[1e39] * 384]})  # inf as float32
+        r = self.client.post("/search_batch", content=body)
+        self.assertEqual(400, r.status_code)
+        self.assertEqual("Query vector must be finite", r.json().get("detail"))
+
+    def test__can_search_with_binary_request_body(self):
+        qvec = np.random.random(384).astype("<f4")
+        headers = {"content-type": "application/octet-stream"}
+        r = self.client.post("/search?n=5", content=qvec.tobytes(), headers=headers)
+        self.assertEqual(200, r.status_code)
+
+        results = r.json().get("results")
+        self.followsJsonSchema(results, self.results_schema)
+
+    def test__can_search_in_batch(self):
+        body = {"queries": np.random.random((3, 384)).tolist(), "n": 5}
+        r = self.client.post("/search_batch", json=body)
+        self.assertEqual(200, r.status_code)
+
+        results = r.json().get("results")
+        self.assertEqual(3, len(results))
+        for query_results in results:
+            self.followsJsonSchema(query_results, self.results_schema)
+
+    def test__error_if_batch_options_invalid(self):
+        queries = np.random.random((2, 384)).tolist()
+        for options in [
+            {"index": 5},
+            {"index": ["a"]},
+            {"nprobe": "x"},
+            {"nprobe": 3.5},
+            {"nprobe": 0},
+            {"nprobe": [1]},
+        ]:
+            body = {"queries": queries, "n": 5, **options}
+            r = self.client.post("/search_batch", json=body)
+            self.assertEqual(400, r.status_code)
+            self.assertEqual("Invalid JSON body", r.json().get("detail"))
+
+    def test__query_vector_with_wrong_dimensions(self):
+        """Make sure HTTP 400 is returned when the query vector does not fit
+        the indexes
+        """
+        params = {"mode": "vector", "query": json.dumps([0.1, 0.2]), "n": 5}
+        r = self.client.get("/search", params=params)
+        self.assertEqual(400, r.status_code)
+
     def followsJsonSchema(self, data, schema):
         try:
             validate(data, schema)
@@ -84,5 +197,43 @@ class TestAPI(unittest.TestCase):
             self.fail(f"Invalid results schema: {e}")
 
 
+class TestWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        self.index = mock.Mock()
+        self.index.dims.return_value = 16
+        patcher = mock.patch.object(
+            main, "get_target_indexes", return_value=[self.index]
+        )
+        self.get_target_indexes = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test__searches_every_target(self):
+        main.warm_up()
+        self.get_target_indexes.assert_called_once_with()
+        self.index.search_batch.assert_called_once()
+        qvecs, n = self.index.search_batch.call_args.args
+        self.assertEqual((main.WARMUP_BATCH_SIZE, 16), qvecs.shape)
+        self.assertEqual(np.float32, qvecs.dtype)
+
+    def test__prefetches_index_files_if_enabled(self):
+        storage = main.index_storage
+        with mock.patch.object(main, "PREFETCH_INDEXES", True), mock.patch.object(
+            storage, "available", return_value=["A.abs", "B.abs"]
+        ), mock.patch.object(storage, "prefetch") as prefetch:
+            main.warm_up()
+        self.assertEqual(
+            [mock.call("A.abs"), mock.call("B.abs")], prefetch.call_args_list
+        )
+
+    def test__no_prefetch_if_disabled(self):
+        storage = main.index_storage
+        with mock.patch.object(main, "PREFETCH_INDEXES", False), mock.patch.object(
+            storage, "prefetch"
+        ) as prefetch:
+            main.warm_up()
+        prefetch.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,69 @@
+"""Tests for merging results of several indexes
+"""
+import unittest
+import sys
+from pathlib import Path
+import numpy as np
+
+BASE_DIR = str(Path(__file__).parent.parent.resolve())
+sys.path.append(BASE_DIR)
+
+from core.topk import merge_topk, merge_topk_rows, group_by_shard
+
+
+class TestMergeTopK(unittest.TestCase):
+    """Tests for the `merge_topk` function"""
+
+    def test_merges_results_of_indexes(self):
+        """Are the best results picked from all indexes in order?"""
+        dists = np.array([0.1, 0.4, 0.5, 0.2, 0.3, 0.9], dtype="float32")
+        ids = np.array([7, 8, 9, 4, 5, 6])
+        shards = np.array([0, 0, 0, 1, 1, 1])
+        shards, ids, dists = merge_topk(dists, ids, shards, 4)
+        self.assertEqual([0, 1, 1, 0], shards.tolist())
+        self.assertEqual([7, 4, 5, 8], ids.tolist())
+        np.testing.assert_allclose([0.1, 0.2, 0.3, 0.4], dists)
+
+    def test_skips_missing_results(self):
+        """Are results with id -1 left out?"""
+        dists = np.array([0.1, np.inf, 0.2, 0.3], dtype="float32")
+        ids = np.array([3, -1, 1, 2])
+        shards = np.array([0, 0, 1, 1])
+        shards, ids, _ = merge_topk(dists, ids, shards, 10)
+        self.assertEqual([0, 1, 1], shards.tolist())
+        self.assertEqual([3, 1, 2], ids.tolist())
+
+    def test_no_results(self):
+        """Does it handle the case when no index found anything?"""
+        ids = np.full(6, -1)
+        shards, ids, dists = merge_topk(np.zeros(6), ids, np.zeros(6, int), 5)
+        self.assertEqual(0, len(shards))
+        self.assertEqual(0, len(ids))
+        self.assertEqual(0, len(dists))
+
+    def test_merges_rows_of_a_batch(self):
+        """Is every query of a batch merged on its own?"""
+        dists = np.array([[0.1, 0.4, 0.2, 0.3], [0.5, 0.1, 0.3, 0.2]])
+        ids = np.array([[1, 2, 3, -1], [1, 2, 3, 4]])
+        shards = np.array([0, 0, 1, 1])
+        merged = merge_topk_rows(dists, ids, shards, 3)
+        self.assertEqual(2, len(merged))
+        self.assertEqual([1, 3, 2], merged[0][1].tolist())
+        self.assertEqual([2, 4, 3], merged[1][1].tolist())
+        self.assertEqual([0, 1, 1], merged[1][0].tolist())
+
+
+class TestGroupByShard(unittest.TestCase):
+    """Tests for the `group_by_shard` function"""
+
+    def test_groups_ids(self):
+        """Are ids grouped by index along with their positions?"""
+        groups = group_by_shard(np.array([1, 0, 1]), np.array([5, 6, 7]))
+        self.assertEqual([0, 1], sorted(groups))
+        positions, ids = groups[1]
+        self.assertEqual([0, 2], positions.tolist())
+        self.assertEqual([5, 7], ids.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()